@@ -19,37 +19,80 @@ Available script options. Flash USB device:
  - with appropriate bios set in default config:     dek_flash.py --dev <usb_device_path>
  - with appropriate bios set in provided config:    dek_flash.py --dev <usb_device_path> --config <config_yaml_path>
  - with appropriate image specified by url:         dek_flash.py --dev <usb_device_path> --url <image_url>
+   (add --verify-url to check that the image is reachable before flashing)
 """
 
-import argparse
+import functools
 import logging
+import operator
 import os
-import pathlib
 import signal
 import subprocess  # nosec - bandit: security considered
 import sys
-import traceback
-import urllib.request
-import urllib.parse
-import urllib.error
-from socket import timeout
+import types
 
 import seo.error
-import seo.git
-import seo.stage
 
-try:
-    import yaml
-except ModuleNotFoundError:
-    sys.stderr.write(
-        "ERROR: Couldn't import yaml module.\n"
-        "   It can be installed using following command:\n"
-        "   $ pip3 install pyyaml\n")
-    sys.exit(seo.error.Codes.MISSING_PREREQUISITE)
+
+_DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "default_config.yml")
+
+# bios type to flash for the (bios, efi) config settings; None means the user has to choose
+_BIOS_CHOICES = {
+    (True, True): None,
+    (True, False): "bios",
+    (False, True): "efi",
+    (False, False): "error",
+}
+
+# options recognized by parse_args() without argparse, mapped to the attributes they set;
+# these have to be kept in sync with _parse_args_full()
+_VALUE_OPTS = {
+    "-d": "dev_path", "--dev": "dev_path",
+    "-u": "image_url", "--url": "image_url",
+    "-c": "config_file", "--config": "config_file",
+}
+_FLAG_OPTS = {
+    "--verify-url": "verify_url",
+    "--debug": "debug",
+}
+
+_SCRIPT_TERMINATE_TIMEOUT = 2 # seconds
+_SCRIPT_EXIT_TIMEOUT = 5 # seconds
 
 
 def parse_args(default_config_path, experience_kit_name):
-    """ Parse script arguments """
+    """ Parse script arguments
+
+        Argument lists made of known options only are handled directly, to avoid loading argparse.
+        Anything else (help, unknown or abbreviated options, missing values) is passed to argparse,
+        so that it can print the usage and error messages.
+    """
+
+    args = types.SimpleNamespace(
+        dev_path=None, image_url=None, verify_url=False, config_file=default_config_path, debug=False)
+
+    argv = iter(sys.argv[1:])
+    for arg in argv:
+        name, has_value, value = arg.partition("=") if arg.startswith("--") else (arg, "", "")
+
+        if name in _VALUE_OPTS:
+            if not has_value:
+                value = next(argv, None)
+                if value is None or value.startswith("-"):
+                    return _parse_args_full(default_config_path, experience_kit_name)
+            setattr(args, _VALUE_OPTS[name], value)
+        elif arg in _FLAG_OPTS:
+            setattr(args, _FLAG_OPTS[arg], True)
+        else:
+            return _parse_args_full(default_config_path, experience_kit_name)
+
+    return args
+
+
+def _parse_args_full(default_config_path, experience_kit_name):
+    """ Parse script arguments using argparse """
+
+    import argparse  # pylint: disable=import-outside-toplevel
 
     experience_kit_name = (
         "" if experience_kit_name is None else
@@ -64,6 +107,9 @@ def parse_args(default_config_path, experience_kit_name):
     p.add_argument(
         "-u", "--url", action="store", dest="image_url", metavar="PATH",
         help="URL of the USB Image")
+    p.add_argument(
+        "--verify-url", action="store_true", dest="verify_url",
+        help="check that the USB Image URL is reachable before flashing")
     p.add_argument(
         "-c", "--config", action="store", dest="config_file", metavar="PATH",
         default=default_config_path,
@@ -75,30 +121,67 @@ def parse_args(default_config_path, experience_kit_name):
     return p.parse_args()
 
 
-def get_config(config_file_path):
-    """ Read and parse given provisioning config file """
+@functools.lru_cache(maxsize=None)
+def _import_yaml():
+    """ Import yaml module and pick its loader on first use, so that e.g. printing help doesn't load it """
 
-    logging.debug("Trying to read and parse provisioning configuration file ('%s')", config_file_path)
+    # pylint: disable=import-outside-toplevel
+    try:
+        import yaml
+    except ModuleNotFoundError:
+        sys.stderr.write(
+            "ERROR: Couldn't import yaml module.\n"
+            "   It can be installed using following command:\n"
+            "   $ pip3 install pyyaml\n")
+        sys.exit(seo.error.Codes.MISSING_PREREQUISITE)
+
+    if not hasattr(yaml, "CSafeLoader"):
+        sys.stderr.write(
+            "WARNING: yaml module was built without libyaml bindings, falling back to slower pure-Python parser.\n"
+            "   Install libyaml development files (e.g. libyaml-dev) and reinstall pyyaml to enable it.\n")
+
+    return yaml, getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+
+def _load_yaml(file_path):
+    """ Parse given yaml file """
 
     try:
-        with open(config_file_path) as config_file:
-            raw_config = config_file.read()
-    except (FileNotFoundError, PermissionError) as e:
+        input_file = open(file_path, "rb")
+    except (FileNotFoundError, PermissionError, IsADirectoryError) as e:
         raise seo.error.AppException(
             seo.error.Codes.ARGUMENT_ERROR,
             f"Failed to load the config file: {e}") from e
 
-    try:
-        return yaml.safe_load(raw_config)
-    except yaml.YAMLError as e:
-        raise seo.error.AppException(
-            seo.error.Codes.CONFIG_ERROR,
-            f"Config file format error: {e}") from e
+    with input_file:
+        yaml, loader = _import_yaml()
+
+        # let the parser read the file in chunks instead of loading it into a string first
+        try:
+            return yaml.load(input_file, Loader=loader)  # nosec - B506: safe loader is used
+        except yaml.YAMLError as e:
+            raise seo.error.AppException(
+                seo.error.Codes.CONFIG_ERROR,
+                f"Config file format error: {e}") from e
+
+
+def get_config(config_file_path):
+    """ Read and parse given provisioning config file """
+
+    logging.debug("Trying to read and parse provisioning configuration file ('%s')", config_file_path)
+
+    return _load_yaml(config_file_path)
 
 
 def check_preconditions(args):
     """ Check script's preconditions """
 
+    # pylint: disable=import-outside-toplevel
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+    from socket import timeout
+
     logging.debug("Checking preconditions")
 
     # check current user permissions
@@ -112,39 +195,45 @@ def check_preconditions(args):
             seo.error.Codes.MISSING_PREREQUISITE,
             "Device path not specified.")
 
-    dev_path = pathlib.Path(args.dev_path)
-
-    if not dev_path.exists():
+    if not os.path.exists(args.dev_path):
         raise seo.error.AppException(
             seo.error.Codes.MISSING_PREREQUISITE,
-            f"Device path does not exist in expected location '{dev_path}'")
+            f"Device path does not exist in expected location '{args.dev_path}'")
 
     # check if image is accessible and is in the right format
     if args.image_url:
         parsed = urllib.parse.urlparse(args.image_url)
         url = parsed.geturl()
+        lower_url = url.lower()
 
-        if not url.lower().startswith('http'):
+        if not lower_url.startswith('http'):
             raise seo.error.AppException(
                 seo.error.Codes.ARGUMENT_ERROR,
                 "URL format incorrect, should start with http:\n"
                 f"    {url}")
 
-        if not url.lower().endswith('.img'):
+        if not lower_url.endswith('.img'):
             raise seo.error.AppException(
                 seo.error.Codes.ARGUMENT_ERROR,
                 "URL is not pointing to an img file:\n"
                 f"    {url}")
 
-        if all(bios_type not in url for bios_type in ("-bios", "-efi")):
+        if "-bios" not in lower_url and "-efi" not in lower_url:
             raise seo.error.AppException(
                 seo.error.Codes.ARGUMENT_ERROR,
                 "URL is not pointing to an acceptable file. "
                 "Provided image should have a format of: {profile}-{bios}.img\n"
                 f"    {url}")
 
+        # reaching the image server costs a network round-trip, so it is only done on request
+        if not args.verify_url:
+            return
+
+        # only headers are needed to validate the URL, don't download the image itself
+        request = urllib.request.Request(url, method="HEAD")
         try:
-            urllib.request.urlopen(url, timeout=1)  # nosec - bandit: security considered
+            with urllib.request.urlopen(request, timeout=1):  # nosec - bandit: security considered
+                pass
         except (urllib.error.HTTPError, urllib.error.URLError, timeout) as e:
             raise seo.error.AppException(
                 seo.error.Codes.ARGUMENT_ERROR,
@@ -159,7 +248,7 @@ def choose_profile(config):
     logging.debug("Choosing OS profile based on configuration file ('%s')", config)
 
     usb_config = config['usb_images']
-    profiles = [profile['name'] for profile in config['profiles']]
+    profiles = list(map(operator.itemgetter('name'), config['profiles']))
 
     if not usb_config['all_in_one']:
         logging.info("All-in-one image generation set to false in config.\n")
@@ -201,22 +290,18 @@ def choose_bios(config):
             seo.error.Codes.CONFIG_ERROR,
             "Build parameter set to false in config.")
 
-    if usb_config['bios'] and usb_config['efi']:
-        bios_type = input("Which bios type image do you want write to USB? ('bios' or 'efi'): ")
+    bios = _BIOS_CHOICES[(bool(usb_config['bios']), bool(usb_config['efi']))]
+
+    if bios is None:
+        bios = input("Which bios type image do you want write to USB? ('bios' or 'efi'): ")
 
-        if bios_type not in ("bios", "efi"):
+        if bios not in ("bios", "efi"):
             raise seo.error.AppException(
                 seo.error.Codes.ARGUMENT_ERROR,
                 "Wrong bios type specified:\n"
-                f"    {bios_type}")
-
-        bios = bios_type
+                f"    {bios}")
 
-    elif usb_config['bios']:
-        bios = "bios"
-    elif usb_config['efi']:
-        bios = "efi"
-    else:
+    elif bios == "error":
         raise seo.error.AppException(
             seo.error.Codes.CONFIG_ERROR,
             "Couldn't recognize expected bios type. Both 'bios' and 'efi' set to false. Check config.")
@@ -229,53 +314,53 @@ def generate_command(config, dev_path, profile, bios):
         Provided image should have a format of: {profile}-{bios}.img
     """
 
-    workdir = pathlib.Path(config['usb_images']['output_path'])
-
-    image_path = workdir / f"{profile}-{bios}.img"
+    image_path = os.path.join(config['usb_images']['output_path'], f"{profile}-{bios}.img")
 
-    if not image_path.exists():
+    if not os.path.isfile(image_path):
         raise seo.error.AppException(
             seo.error.Codes.RUNTIME_ERROR,
             "Installation image couldn't be found in expected location:\n"
             f"    {image_path}")
 
-    return ['./flashusb.sh', '-d', str(dev_path), '-i', ("../" + str(image_path)), '-b', str(bios)]
+    return ['./flashusb.sh', '-d', dev_path, '-i', f"../{image_path}", '-b', bios]
 
 
 def run_flash_usb_script(config, cmd):
     """ Helper to run ESP flashusb.sh script """
 
-    if isinstance(cmd, list):
-        cmd = " ".join(cmd)
-
-    # convert to Path if string was passed
-    workdir = pathlib.Path(config['esp']['dest_dir'])
-    if not workdir.exists():
+    workdir = config['esp']['dest_dir']
+    if not os.path.isdir(workdir):
         raise seo.error.AppException(
             seo.error.Codes.CONFIG_ERROR,
-            f"Workdir does not exist in expected location '{workdir}', required by '{cmd}'")
+            f"Workdir does not exist in expected location '{workdir}', required by '{' '.join(cmd)}'")
 
-    logging.debug("Running command: %s", cmd)
-    with subprocess.Popen(cmd, shell=True, cwd=workdir) as proc: # nosec - B602
+    logging.debug("Running command: %s", " ".join(cmd))
+    # script writes directly to the inherited stdout, make sure nothing written earlier gets reordered
+    sys.stdout.flush()
+    # script is started in its own session, so that its whole process group can be killed on interrupt
+    proc = subprocess.Popen(cmd, cwd=workdir, start_new_session=True) # nosec - B603 (subprocess call)
+    try:
+        if proc.wait() != 0:
+            raise RuntimeError(
+                f"Running ESP script failed. Inspect output and logs in {workdir}/builder.log")
+    except KeyboardInterrupt as e:
+        # gracefully handle SIGINT, kill script that may be stuck in background.
+        # note: since script can start bunch of other scripts, it sometimes is not killed with simple
+        # proc.terminate() or proc.kill(), therefore we need to kill whole process group.
+        os.killpg(proc.pid, signal.SIGTERM)
+        try:
+            proc.wait(timeout=_SCRIPT_TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+        raise RuntimeError("Interrupted by user") from e
+    finally:
+        # don't wait indefinitely for the script that is still finishing when exiting,
+        # kill whole process group for the same reason as above
         try:
-            while proc.poll() is None:
-                if proc.stdout is None:
-                    continue
-
-                line = proc.stdout.readline()
-                if line:
-                    # newlines are already contained in the output
-                    print(line, end='')
-
-            if proc.poll() != 0:
-                raise RuntimeError(
-                    f"Running ESP script failed. Inspect output and logs in {workdir}/builder.log")
-        except KeyboardInterrupt as e:
-            # gracefully handle SIGINT, kill script that may be stuck in background.
-            # note: since script can start bunch of other scripts, it sometimes is not killed with simple
-            # proc.terminate() or proc.kill(), therefore we need to kill whole process group.
-            os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
-            raise RuntimeError("Interrupted by user") from e
+            proc.wait(timeout=_SCRIPT_EXIT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
 
 
 # ---------------------------------------------
@@ -284,10 +369,8 @@ def run_flash_usb_script(config, cmd):
 def run_main(default_config_path=None, experience_kit_name=""):
     """ Top level script entry function """
 
-    default_config_path = os.path.relpath(
-        os.path.join(
-            os.path.dirname(os.path.realpath(__file__)),
-            "default_config.yml")) if default_config_path is None else default_config_path
+    if default_config_path is None:
+        default_config_path = _DEFAULT_CONFIG_PATH
 
     args = parse_args(default_config_path, experience_kit_name)
 
@@ -295,6 +378,7 @@ def run_main(default_config_path=None, experience_kit_name=""):
         sys.exit(main(args).value)
     except seo.error.AppException as e:
         if args.debug:
+            import traceback  # pylint: disable=import-outside-toplevel
             traceback.print_exc(file=sys.stderr)
         logging.error(e.code if e.msg is None else e.msg)
         sys.exit(e.code.value)
@@ -315,15 +399,14 @@ def main(args):
     logging.basicConfig(level=log_level, format=log_format, datefmt='%Y-%m-%d %H:%M:%S')
 
     cfg = get_config(args.config_file)
-    dev_path = pathlib.Path(args.dev_path)
     url = args.image_url
 
     if not url:
         profile = choose_profile(cfg)
         bios = choose_bios(cfg)
-        cmd = generate_command(cfg, dev_path, profile, bios)
+        cmd = generate_command(cfg, args.dev_path, profile, bios)
     else:
-        cmd = ['./flashusb.sh', '-d', str(dev_path), '-u', str(url)]
+        cmd = ['./flashusb.sh', '-d', args.dev_path, '-u', url]
 
     run_flash_usb_script(cfg, cmd)
 